@@ -5,78 +5,449 @@ Combines git repository cloning with files-to-prompt functionality.
 
 from fastmcp import FastMCP
 import os
-import subprocess
 import sys
-from typing import Optional, List
+import io
+from typing import Optional, List, Dict, Tuple, TextIO, BinaryIO
 import shutil
+import tempfile
 import re
 import hashlib
+import functools
+import uuid
+import time
+from urllib.parse import urlsplit, urlunsplit
 import logging
 import asyncio
 import anyio
-import git
+import httpx
+from files_to_prompt import cli as f2p_cli
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, stream=sys.stderr, format='%(asctime)s - %(levelname)s - %(message)s')
+logger = logging.getLogger("mcp_git_files_server")
+
+def _env_float(name: str, default: float) -> float:
+    """Read a number from an environment variable, falling back to default if it is unset or invalid"""
+    value = os.environ.get(name)
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.warning("Ignoring invalid %s=%r, using %s", name, value, default)
+        return default
+
+# Cloned repositories are kept here across runs and removed after CACHE_TTL_SECONDS without use
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "mcp_git_files_server"
+)
+CACHE_TTL_SECONDS = _env_float("MCP_GIT_FILES_CACHE_TTL", 7 * 24 * 60 * 60)
+
+# Repositories already cloned or refreshed by this process, and per-repository locks guarding them
+_CLONE_MEMO: Dict[str, str] = {}
+_CLONE_LOCKS: Dict[str, asyncio.Lock] = {}
+
+# files-to-prompt runs in worker threads one at a time; calls waiting their turn queue here
+# instead of each holding a thread from anyio's default pool
+_F2P_LIMITER = anyio.CapacityLimiter(1)
+_OUTPUT_FILE_BUFFER_SIZE = 1 << 20
 
 mcp = FastMCP(
     "Git Files-to-Prompt Server",
     dependencies=[
-        "gitpython==3.1.45",
+        "httpx==0.28.1",
         "files-to-prompt==0.6"
     ]
 )
 
+# Known git hosts, or anything ending in .git. GitHub/GitLab repository URLs (which can be downloaded as
+# tarballs) match the first branch, so the same match also yields their host, owner and repo
+_GIT_URL_RE = re.compile(
+    r'^https?://(?P<host>github|gitlab)\.com/(?P<owner>[^/]+)/(?P<repo>[^/]+?)(?:\.git)?$'
+    r'|^git@(?P<shost>github|gitlab)\.com:(?P<sowner>[^/]+)/(?P<srepo>[^/]+?)(?:\.git)?$'
+    r'|^(?:https?://(?:github|gitlab)\.com/|https?://bitbucket\.org/|git@(?:github|gitlab)\.com:|git@bitbucket\.org:)'
+    r'|\.git$'
+)
+_SHA_RE = re.compile(r'[0-9a-f]{40}')
+
+# Tarballs have no .git directory, so the commit they were downloaded at is stored in "<dir>.commit"
+_ARCHIVE_COMMIT_SUFFIX = ".commit"
+# Directories being deleted in the background are renamed to "<dir>.trash-<id>" first
+_TRASH_MARKER = ".trash-"
+# Clones and archive downloads are built in "<dir>.tmp-<id>" and renamed into place once complete. Staging
+# directories older than this were left behind by an interrupted process; newer ones may still be in progress
+_STAGING_MARKER = ".tmp-"
+_STAGING_MAX_AGE_SECONDS = 60 * 60
+
 def is_git_url(path: str) -> bool:
     """Check if a path is a git repository URL"""
-    git_patterns = [
-        r'^https?://github\.com/',
-        r'^https?://gitlab\.com/',
-        r'^https?://bitbucket\.org/',
-        r'^git@github\.com:',
-        r'^git@gitlab\.com:',
-        r'^git@bitbucket\.org:',
-        r'\.git$'
-    ]
-    return any(re.match(pattern, path) for pattern in git_patterns)
-
-async def clone_repo(repo_url: str) -> str:
-    """Clone a repository and return the path. If repository is already cloned in current directory, reuse it."""
-    # Create a deterministic directory name based on repo URL
-    repo_hash = hashlib.sha256(repo_url.encode()).hexdigest()[:12]
-    current_dir = os.getcwd()
-    repo_dir = os.path.join(current_dir, f"git_files_server_{repo_hash}")
+    return _GIT_URL_RE.search(path) is not None
+
+async def _run_git(args: List[str], cwd: Optional[str] = None) -> str:
+    """Run a git command as an asyncio subprocess and return its stdout, raising on failure"""
+    proc = await asyncio.create_subprocess_exec(
+        "git", *args,
+        cwd=cwd,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    # communicate() drains both pipes concurrently, so a chatty stderr can't block the child
+    stdout, stderr = await proc.communicate()
+    if proc.returncode != 0:
+        raise Exception(f"git {args[0]} failed: {stderr.decode(errors='replace').strip()}")
+    return stdout.decode("utf-8", errors="replace")
+
+async def _resolve_remote_head(repo_url: str, ref: Optional[str] = None) -> Optional[Tuple[str, str]]:
+    """Return (commit SHA, full ref name) of the remote's HEAD (or branch/tag ref), or None if it can't be resolved"""
+    if ref:
+        # ls-remote matches patterns against the end of ref names ("dev" also matches "refs/heads/a/dev"), so ask
+        # for the exact names. Branches win over tags, like `git clone --branch`; for an annotated tag the peeled
+        # "^{}" entry is the commit that gets checked out
+        candidates = [f"refs/heads/{ref}", f"refs/tags/{ref}^{{}}", f"refs/tags/{ref}"]
+    else:
+        candidates = ["HEAD"]
+    try:
+        output = await _run_git(["ls-remote", repo_url, *candidates])
+    except Exception as e:
+        logger.warning("Could not resolve remote head of %s: %s", repo_url, e)
+        return None
+    remote_refs = {}
+    for line in output.splitlines():
+        sha, _, name = line.partition("\t")
+        if _SHA_RE.fullmatch(sha):
+            remote_refs[name] = sha
+    for name in candidates:
+        if name in remote_refs:
+            return remote_refs[name], name.removesuffix("^{}")
+    return None
+
+def cleanup_cache(max_age: float = CACHE_TTL_SECONDS) -> None:
+    """Remove cached repositories that haven't been used for more than max_age seconds"""
+    if not os.path.isdir(CACHE_DIR):
+        return
+    cutoff = time.time() - max_age
+    for entry in os.scandir(CACHE_DIR):
+        try:
+            if _TRASH_MARKER in entry.name:
+                # Left behind by _discard_dir if the process exited before deleting it
+                shutil.rmtree(entry.path, ignore_errors=True)
+            elif _STAGING_MARKER in entry.name:
+                if entry.stat().st_mtime < time.time() - _STAGING_MAX_AGE_SECONDS:
+                    shutil.rmtree(entry.path, ignore_errors=True)
+            elif entry.name.endswith(_ARCHIVE_COMMIT_SUFFIX):
+                # Commit records are removed together with their repository, or when orphaned
+                if not os.path.isdir(entry.path[:-len(_ARCHIVE_COMMIT_SUFFIX)]):
+                    os.remove(entry.path)
+            elif entry.stat().st_mtime < cutoff:
+                logger.info("Removing stale cached repository %s", entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+                if os.path.exists(entry.path + _ARCHIVE_COMMIT_SUFFIX):
+                    os.remove(entry.path + _ARCHIVE_COMMIT_SUFFIX)
+        except OSError:
+            continue
+
+def _discard_dir(path: str) -> None:
+    """Move a directory out of the way and delete it in a background thread, so callers don't wait on rmtree"""
+    if not os.path.exists(path):
+        return
+    trash = f"{path}{_TRASH_MARKER}{uuid.uuid4().hex[:8]}"
+    try:
+        os.rename(path, trash)
+    except OSError:
+        # e.g. files still open on Windows - delete in place instead
+        shutil.rmtree(path, ignore_errors=True)
+        return
+    asyncio.get_running_loop().run_in_executor(None, shutil.rmtree, trash, True)
+
+def _publish_dir(staging_dir: str, repo_dir: str) -> None:
+    """Move a complete checkout from its staging directory into its cache entry"""
+    try:
+        os.rename(staging_dir, repo_dir)
+    except OSError:
+        if not os.path.isdir(repo_dir):
+            raise
+        # Another server process finished the same checkout first - keep theirs
+        _discard_dir(staging_dir)
+
+def _archive_url(url_match: re.Match, commit: str) -> str:
+    """Return the tarball download URL of a commit of a GitHub/GitLab repository matched by _GIT_URL_RE"""
+    if url_match.group("host"):
+        host, owner, repo = url_match.group("host", "owner", "repo")
+    else:
+        host, owner, repo = url_match.group("shost", "sowner", "srepo")
+    if host == "github":
+        return f"https://codeload.github.com/{owner}/{repo}/tar.gz/{commit}"
+    return f"https://gitlab.com/{owner}/{repo}/-/archive/{commit}/{repo}-{commit}.tar.gz"
+
+async def _download_archive(archive_url: str, repo_dir: str, extensions: Optional[List[str]] = None) -> None:
+    """Download a repository tarball and extract it into repo_dir"""
+    with tempfile.TemporaryFile() as archive:
+        async with httpx.AsyncClient(follow_redirects=True, timeout=60) as client:
+            async with client.stream("GET", archive_url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_bytes(1 << 16):
+                    archive.write(chunk)
+        archive.seek(0)
+        await anyio.to_thread.run_sync(_extract_archive, archive, repo_dir, extensions)
+
+def _extract_archive(archive: BinaryIO, repo_dir: str, extensions: Optional[List[str]] = None) -> None:
+    """Extract a repository tarball into repo_dir, keeping only files files-to-prompt will read if extensions are given.
+
+    Raises ValueError if the archive can't reproduce a checkout: git archive leaves out export-ignore paths and
+    expands export-subst placeholders, and links are not extracted.
+    """
+    # Only needed for archive downloads, so not imported at server startup
+    import tarfile
+
+    # Use the "data" extraction filter (no special files, permission bits sanitized) where this Python has it
+    extract_kwargs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+    # .gitattributes files are always extracted, since they are needed for the export attribute check
+    keep_suffixes = (*extensions, ".gitignore", ".gitattributes") if extensions else None
+    with tarfile.open(fileobj=archive, mode="r|gz") as tar:
+        for member in tar:
+            # Strip the "<repo>-<commit>/" directory every archive is wrapped in
+            _, _, name = member.name.partition("/")
+            if not name or os.path.isabs(name) or ".." in name.split("/"):
+                continue
+            if keep_suffixes and not member.isdir() and not name.endswith(keep_suffixes):
+                continue
+            # Links could point outside the checkout, so they are not extracted - but a clone would have them
+            if member.issym() or member.islnk():
+                raise ValueError(f"archive contains a link ({name})")
+            if not (member.isfile() or member.isdir()):
+                continue
+            member.name = name
+            tar.extract(member, repo_dir, **extract_kwargs)
+            if member.isfile() and os.path.basename(name) == ".gitattributes":
+                with open(os.path.join(repo_dir, name), "rb") as f:
+                    attributes = f.read()
+                if b"export-ignore" in attributes or b"export-subst" in attributes:
+                    raise ValueError(f"{name} sets export-ignore or export-subst")
+
+def _is_git_checkout(repo_dir: str) -> bool:
+    """Check whether repo_dir contains a .git entry, using a single stat call"""
+    try:
+        os.stat(f"{repo_dir}/.git")
+        return True
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+
+def _sparse_patterns(extensions: List[str]) -> List[str]:
+    """Sparse-checkout patterns matching what files-to-prompt keeps for the given extensions (plus .gitignore rules)"""
+    return [f"*{ext}" for ext in extensions] + ["*.gitignore"]
+
+@functools.lru_cache(maxsize=256)
+def _repo_hash(cache_key: str) -> str:
+    """Deterministic cache directory name for a repository cache key"""
+    return hashlib.sha256(cache_key.encode()).hexdigest()[:12]
+
+def _normalize_repo_url(repo_url: str) -> str:
+    """Normalize a repository URL (trailing slash, scheme and host case) so equivalent spellings share a cache entry"""
+    url = repo_url.rstrip("/")
+    parts = urlsplit(url)
+    if not parts.scheme or not parts.netloc:
+        return url
+    userinfo, at, host = parts.netloc.rpartition("@")
+    return urlunsplit(parts._replace(scheme=parts.scheme.lower(), netloc=f"{userinfo}{at}{host.lower()}"))
+
+async def clone_repo(
+    repo_url: str,
+    ref: Optional[str] = None,
+    extensions: Optional[List[str]] = None,
+    url_match: Optional[re.Match] = None
+) -> str:
+    """Clone a repository into the cache directory and return the path.
+
+    If the repository is already cached, `git ls-remote` is used to check whether it is still current; if not,
+    only the new tip is fetched. An unreachable remote falls back to the cached copy. Within one server process
+    this check only happens the first time a repository is requested.
+
+    Only the tip of a single branch is fetched (shallow clone), since files-to-prompt only reads the current tree.
+    If ref is given, that branch or tag is checked out instead of the remote's default branch.
+    If extensions are given, a partial clone (--filter=blob:none) with a sparse checkout is used, so only the
+    blobs of matching files are downloaded.
+    url_match is the _GIT_URL_RE match of the normalized repo_url, if the caller already has it.
+    """
+    repo_url = _normalize_repo_url(repo_url)
+    # Create a deterministic directory name based on repo URL, ref and extensions, since each yields a different checkout
+    cache_key = repo_url if not ref else f"{repo_url}@{ref}"
+    if extensions:
+        cache_key += "#" + ",".join(sorted(set(extensions)))
+
+    repo_dir = _CLONE_MEMO.get(cache_key)
+    if repo_dir and os.path.isdir(repo_dir):
+        return repo_dir
+
+    # Concurrent requests for the same repository wait for a single clone instead of racing on one directory
+    async with _CLONE_LOCKS.setdefault(cache_key, asyncio.Lock()):
+        repo_dir = _CLONE_MEMO.get(cache_key)
+        if repo_dir and os.path.isdir(repo_dir):
+            return repo_dir
+        repo_dir = await _clone_or_update_repo(repo_url, cache_key, url_match, ref, extensions)
+        _CLONE_MEMO[cache_key] = repo_dir
+        return repo_dir
+
+async def _clone_or_update_repo(
+    repo_url: str,
+    cache_key: str,
+    url_match: Optional[re.Match] = None,
+    ref: Optional[str] = None,
+    extensions: Optional[List[str]] = None
+) -> str:
+    """Clone a repository into the cache directory, or refresh an existing clone, and return the path"""
+    repo_hash = _repo_hash(cache_key)
+    repo_dir = os.path.join(CACHE_DIR, repo_hash)
+    commit_file = f"{repo_dir}{_ARCHIVE_COMMIT_SUFFIX}"
+    remote_sha = remote_ref = None
     
-    # If directory exists and is a valid git repo, return it
-    if os.path.exists(repo_dir):
+    # If directory exists and is a valid git repo, bring it up to date with the remote and return it
+    if _is_git_checkout(repo_dir):
         try:
-            # Simple check if it's a git repository
-            git_dir = os.path.join(repo_dir, '.git')
-            if os.path.exists(git_dir):
-                logging.info(f"Reusing existing repository at {repo_dir}")
+            local_sha = (await _run_git(["rev-parse", "HEAD"], repo_dir)).strip()
+        except Exception as e:
+            # Not a usable checkout (e.g. a corrupted .git) - replace it with a fresh one
+            logger.warning("Discarding broken cached repository at %s: %s", repo_dir, e)
+            _discard_dir(repo_dir)
+        else:
+            remote_sha, remote_ref = await _resolve_remote_head(repo_url, ref) or (None, None)
+            if remote_sha is None or remote_sha == local_sha:
+                logger.info("Reusing existing repository at %s", repo_dir)
+            else:
+                # Upstream moved - fetch just the new tip instead of recloning
+                logger.info("Updating %s from %s to %s...", repo_dir, local_sha[:12], remote_sha[:12])
+                try:
+                    await _run_git(["fetch", "--depth=1", "--no-tags", "origin", remote_ref], repo_dir)
+                    await _run_git(["reset", "--hard", "FETCH_HEAD"], repo_dir)
+                except Exception as e:
+                    # e.g. a network hiccup - the cached checkout is still usable, so keep it
+                    logger.warning("Failed to update cached repository at %s, using it as is: %s", repo_dir, e)
+            # Mark as recently used for the cache cleanup sweep
+            os.utime(repo_dir)
+            return repo_dir
+    elif os.path.isdir(repo_dir):
+        # Extracted from an archive - the commit it was downloaded at is recorded next to it
+        remote_sha, remote_ref = await _resolve_remote_head(repo_url, ref) or (None, None)
+        try:
+            with open(commit_file, "r") as f:
+                local_sha = f.read().strip()
+        except FileNotFoundError:
+            local_sha = ""
+        # A missing or malformed record can't be trusted - download again
+        if _SHA_RE.fullmatch(local_sha) and remote_sha in (None, local_sha):
+            logger.info("Reusing existing repository at %s", repo_dir)
+            os.utime(repo_dir)
+            return repo_dir
+        # Archives can't be updated incrementally, download the new commit from scratch
+        _discard_dir(repo_dir)
+        if os.path.exists(commit_file):
+            os.remove(commit_file)
+
+    # Public GitHub/GitLab repositories can be downloaded as a single tarball, which is cheaper than a clone
+    if url_match is None:
+        url_match = _GIT_URL_RE.search(repo_url)
+    if url_match and (url_match.group("host") or url_match.group("shost")):
+        if remote_sha is None:
+            remote_sha, remote_ref = await _resolve_remote_head(repo_url, ref) or (None, None)
+        if remote_sha:
+            archive_url = _archive_url(url_match, remote_sha)
+            staging_dir = f"{repo_dir}{_STAGING_MARKER}{uuid.uuid4().hex[:8]}"
+            os.makedirs(staging_dir)
+            try:
+                logger.info("Downloading %s to %s...", archive_url, repo_dir)
+                await _download_archive(archive_url, staging_dir, extensions)
+                with open(commit_file, "w") as f:
+                    f.write(remote_sha)
+                _publish_dir(staging_dir, repo_dir)
+                logger.info("Downloaded repository to %s", repo_dir)
                 return repo_dir
-        except Exception:
-            # If there's any error with existing repo, clean it up
-            shutil.rmtree(repo_dir, ignore_errors=True)
+            except Exception as e:
+                # e.g. a private repository (404) - fall back to git, which can use the user's credentials - or an
+                # archive that differs from a checkout
+                logger.warning("Archive download failed, falling back to git clone: %s", e)
+                _discard_dir(staging_dir)
     
-    # Create directory and clone repository
-    os.makedirs(repo_dir, exist_ok=True)
+    # Clone next to the cache entry and only move it into place once checked out, so an interrupted clone (or one
+    # still running in another server process) is never mistaken for a usable checkout
+    staging_dir = f"{repo_dir}{_STAGING_MARKER}{uuid.uuid4().hex[:8]}"
+    os.makedirs(staging_dir)
     try:
-        logging.info(f"Cloning {repo_url} to {repo_dir}...")
+        logger.info("Cloning %s to %s...", repo_url, repo_dir)
+        clone_args = ["--depth=1", "--single-branch", "--no-tags", *(["--branch", ref] if ref else [])]
 
-        def _clone_repo():
-            repo = git.Repo.clone_from(repo_url, repo_dir)
-            return repo
-        
-        result = await anyio.to_thread.run_sync(_clone_repo)
-        logging.info(f"Cloned repository: {result}")
+        if extensions:
+            try:
+                await _run_git(
+                    ["clone", *clone_args, "--filter=blob:none", "--no-checkout", "--", repo_url, staging_dir]
+                )
+                await _run_git(["sparse-checkout", "set", "--no-cone", *_sparse_patterns(extensions)], staging_dir)
+                await _run_git(["checkout"], staging_dir)
+                _publish_dir(staging_dir, repo_dir)
+                logger.info("Cloned repository to %s", repo_dir)
+                return repo_dir
+            except Exception as e:
+                # e.g. the server or local git doesn't support partial clones - retry with a regular clone
+                logger.warning("Partial clone failed, falling back to a full checkout: %s", e)
+                _discard_dir(staging_dir)
+
+        await _run_git(["clone", *clone_args, "--", repo_url, staging_dir])
+        _publish_dir(staging_dir, repo_dir)
+        logger.info("Cloned repository to %s", repo_dir)
         return repo_dir
 
     except Exception as e:
-        # Clean up on error
-        shutil.rmtree(repo_dir, ignore_errors=True)
+        # Clean up on error (in the background, so the error is reported right away)
+        _discard_dir(staging_dir)
         raise Exception(f"Error cloning repository: {str(e)}")
 
+def _run_files_to_prompt(
+    paths: List[str],
+    extensions: List[str],
+    include_hidden: bool,
+    ignore_files_only: bool,
+    ignore_gitignore: bool,
+    ignore_patterns: List[str],
+    output_format: str,
+    include_line_numbers: bool,
+    out: TextIO
+) -> None:
+    """Run files-to-prompt in-process (mirroring its CLI entry point) and write the result to out.
+
+    files-to-prompt numbers cxml documents with a module-level counter, so calls must not overlap -
+    run this through anyio.to_thread.run_sync with limiter=_F2P_LIMITER.
+    """
+    for path in paths:
+        if not os.path.exists(path):
+            raise Exception(f"Path does not exist: {path}")
+
+    claude_xml = output_format == "cxml"
+    markdown = output_format == "markdown"
+
+    def writer(s: str) -> None:
+        print(s, file=out)
+
+    f2p_cli.global_index = 1
+    gitignore_rules = []
+    if claude_xml:
+        writer("<documents>")
+    for path in paths:
+        if not ignore_gitignore:
+            gitignore_rules.extend(f2p_cli.read_gitignore(os.path.dirname(path)))
+        f2p_cli.process_path(
+            path,
+            tuple(extensions),
+            include_hidden,
+            ignore_files_only,
+            ignore_gitignore,
+            gitignore_rules,
+            ignore_patterns,
+            writer,
+            claude_xml,
+            markdown,
+            include_line_numbers
+        )
+    if claude_xml:
+        writer("</documents>")
+
 @mcp.tool()
 async def files_to_prompt(
     paths: List[str], 
@@ -87,7 +458,8 @@ async def files_to_prompt(
     ignore_gitignore: bool = False,
     output_format: str = "default",
     include_line_numbers: bool = False,
-    output_file: str = "" 
+    output_file: str = "",
+    ref: str = ""
 ) -> str:
     """
     Concatenate files into a single prompt for use with LLMs.
@@ -102,13 +474,18 @@ async def files_to_prompt(
         ignore_gitignore: Ignore .gitignore rules
         output_format: Output format - "default", "cxml", or "markdown"
         include_line_numbers: Include line numbers in output
-        output_file: If provided, save the output to this file path. Empty string means no file output.
+        output_file: If provided, save the output to this file path and return a short summary instead of the
+            output. Empty string means no file output.
+        ref: Branch or tag to check out for git repository URLs. Empty string means the remote's default branch.
+            Applies to every git URL in paths, so only set it when processing a single repository - a ref missing
+            from any of them fails the whole call.
     """
-    logging.info(f"files_to_prompt paths: {paths}")
+    logger.info("files_to_prompt paths: %s", paths)
     # Convert empty lists/strings to None for internal function
     extensions_param = extensions if extensions else None
     ignore_patterns_param = ignore_patterns if ignore_patterns else None
     output_file_param = output_file if output_file else None
+    ref_param = ref if ref else None
     
     return await _files_to_prompt_internal(
         paths=paths,
@@ -119,7 +496,8 @@ async def files_to_prompt(
         ignore_gitignore=ignore_gitignore,
         output_format=output_format,
         include_line_numbers=include_line_numbers,
-        output_file=output_file_param
+        output_file=output_file_param,
+        ref=ref_param
     )
 
 async def _files_to_prompt_internal(
@@ -131,110 +509,94 @@ async def _files_to_prompt_internal(
     ignore_gitignore: bool = False,
     output_format: str = "default",
     include_line_numbers: bool = False,
-    output_file: Optional[str] = None
+    output_file: Optional[str] = None,
+    ref: Optional[str] = None
 ) -> str:
     
     """Internal function for files_to_prompt logic"""
 
-    logging.info(f"files_to_prompt_internal paths: {paths}")
-    processed_paths = []
-    temp_dirs = []
+    logger.info("files_to_prompt_internal paths: %s", paths)
     
+    async def _process_path(path: str) -> str:
+        logger.info("Processing path: %s", path)
+        # One search both detects git URLs and yields the host, owner and repo for GitHub/GitLab archive downloads
+        repo_url = _normalize_repo_url(path)
+        url_match = _GIT_URL_RE.search(repo_url)
+        if url_match:
+            return await clone_repo(repo_url, ref, extensions, url_match)
+        return path
+
     try:
-        # Process each path - clone if it's a git URL, otherwise use as-is
-        for path in paths:
-            logging.info(f"Processing path: {path}")
-            if is_git_url(path):
-                cloned_path = await clone_repo(path)
-                processed_paths.append(cloned_path)
-                temp_dirs.append(cloned_path)
-            else:
-                processed_paths.append(path)
-        
-        # Build command for files-to-prompt
-        cmd = ["files-to-prompt"]
-        cmd.extend(processed_paths)
-        
-        # Add options
-        if extensions:
-            for ext in extensions:
-                cmd.extend(["-e", ext])
-        
-        if include_hidden:
-            cmd.append("--include-hidden")
-        
-        if ignore_patterns:
-            for pattern in ignore_patterns:
-                cmd.extend(["--ignore", pattern])
+        # Process each path - clone if it's a git URL, otherwise use as-is.
+        # Clones are independent network operations, so run them concurrently (gather preserves order)
+        processed_paths = list(await asyncio.gather(*(_process_path(path) for path in paths)))
         
-        if ignore_files_only:
-            cmd.append("--ignore-files-only")
-        
-        if ignore_gitignore:
-            cmd.append("--ignore-gitignore")
-        
-        if output_format == "cxml":
-            cmd.append("--cxml")
-        elif output_format == "markdown":
-            cmd.append("--markdown")
-        
-        if include_line_numbers:
-            cmd.append("--line-numbers")
-        
-        if output_file:
-            cmd.extend(["-o", output_file])
-        
-        # Execute the command
-        logging.info(f"Executing command: {' '.join(cmd)}")
-
-        def _run_f2p():
-            return subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                check=False,
-                stdin=subprocess.DEVNULL
-            )
-
-        result = await anyio.to_thread.run_sync(_run_f2p)
+        logger.info("Running files-to-prompt on: %s", processed_paths)
+        f2p_args = (
+            processed_paths,
+            extensions or [],
+            include_hidden,
+            ignore_files_only,
+            ignore_gitignore,
+            ignore_patterns or [],
+            output_format,
+            include_line_numbers
+        )
 
-        if result.returncode != 0:
-            logging.error(f"Command failed with return code {result.returncode}")
-            logging.error(f"stderr: {result.stderr}")
-            raise Exception(f"Failed to run files-to-prompt: {result.stderr}")
-        
         if output_file:
-            logging.error(f"No output was written to {output_file}")
-            return result.stdout #f"Error: No output was written to {output_file}"
+            def _run_f2p():
+                # Output goes straight from files-to-prompt into the file; a large buffer batches the many small writes
+                with open(output_file, "w", encoding="utf-8", buffering=_OUTPUT_FILE_BUFFER_SIZE) as out:
+                    _run_files_to_prompt(*f2p_args, out)
+
+            await anyio.to_thread.run_sync(_run_f2p, limiter=_F2P_LIMITER)
+            # The prompt can be huge - report where it went instead of returning it a second time
+            return f"Wrote {os.path.getsize(output_file)} bytes to {output_file}"
         else:
-            return result.stdout
+            def _run_f2p():
+                out = io.StringIO()
+                _run_files_to_prompt(*f2p_args, out)
+                return out.getvalue()
+
+            return await anyio.to_thread.run_sync(_run_f2p, limiter=_F2P_LIMITER)
        
     except Exception as e:
-        logging.error(f"Error running files-to-prompt: {str(e)}")
+        logger.error("Error running files-to-prompt: %s", e)
         return f"Error running files-to-prompt: {str(e)}"
 
 def main():
     """Entry point for the MCP server"""
-    import sys
-
     args = sys.argv[1:]
+
+    # Configure logging (level overridable, e.g. MCP_GIT_FILES_LOG_LEVEL=WARNING to skip per-path records)
+    log_level = (os.environ.get("MCP_GIT_FILES_LOG_LEVEL") or "INFO").upper()
+    # getLevelName returns the level number for known names and a "Level ..." string for anything else
+    valid_log_level = isinstance(logging.getLevelName(log_level), int)
+    logging.basicConfig(
+        level=log_level if valid_log_level else logging.INFO,
+        stream=sys.stderr,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    if not valid_log_level:
+        logger.warning("Ignoring invalid MCP_GIT_FILES_LOG_LEVEL=%r, using INFO", log_level)
     
+    cleanup_cache()
+
     # Check if running as MCP server (no arguments) or with git repo argument
     if not args or args[0].startswith("-"):
-        logging.info("Running as MCP server")
+        logger.info("Running as MCP server")
         mcp.run()
         return
     
     repo_url = args[0]
     async def process_repo():
-        logging.info(f"Processing repository: {repo_url}")
+        logger.info("Processing repository: %s", repo_url)
         try:
             result = await _files_to_prompt_internal(
                 paths=[repo_url],
-                output_format="markdown",
-                # output_file="mcp_test_output.txt"
+                output_format="markdown"
             )
-            logging.info(f"Output length: {len(str(result))} characters")
+            logger.info("Output length: %s characters", len(str(result)))
         except Exception as e:
             print(f"Error processing repository: {e}")
             sys.exit(1)
@@ -27,7 +27,7 @@ setup(
     python_requires=">=3.10",
     install_requires=[
         "fastmcp==2.11.3",
-        "gitpython==3.1.45",
+        "httpx==0.28.1",
         "files-to-prompt==0.6"
     ],
     entry_points={